@@ -2,110 +2,649 @@
 """
 Example FastAPI application for extracting video I-frames with FFmpeg,
 plus an HTML page to upload a video and download frames.
+
+Development:
+
+    uvicorn fastapi_app:app --reload
+
+Production (see run.sh):
+
+    uvicorn fastapi_app:app --loop uvloop --http httptools --workers $(nproc)
+
+Every worker shares OUTPUT_DIR so any of them can serve a frame that
+another one extracted; frames_cache is per worker and falls back to disk.
+MAX_CACHE_MB and the probe pool are per worker too, so total memory grows
+with --workers.
+Each worker keeps its own KEEP_UPLOADS most recent uploads and deletes
+older ones, so the page can show the latest finished upload from any worker.
+
+Behind nginx (see nginx.conf), set FRAMES_ACCEL_PREFIX=/_frames/ so frames
+that aren't cached in memory are handed to nginx with X-Accel-Redirect and
+sent with sendfile(2) instead of being copied through Python.
 """
 
+import asyncio
+import hashlib
+import multiprocessing
 import os
-import sys
+import re
 import shutil
+import sys
 import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from zipfile import ZipFile
-from typing import List, Optional
+from functools import lru_cache
+from typing import AsyncIterator, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
+import aiofiles
+import multipart
+from fastapi import FastAPI, Form, HTTPException, Request
+from fastapi.responses import HTMLResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from multipart.exceptions import FormParserError
+from multipart.multipart import parse_options_header
 
 from pydantic import BaseModel
-from PIL import Image
+from zipstream import ZipStream
+
+from frame_hash import perceptual_hash
 
 app = FastAPI()
 
 templates = Jinja2Templates(directory="templates")
 
-OUTPUT_DIR = "output_frames"
+OUTPUT_DIR = "output_frames"  # One subdirectory per upload
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-frames_cache = {}  # In-memory cache for frames
+# Written once an upload's frames are all on disk; its mtime orders finished uploads.
+UPLOAD_DONE_MARKER = ".done"
+# Uploads this worker keeps on disk, oldest first. Each worker prunes only its own.
+KEEP_UPLOADS = int(os.environ.get("KEEP_UPLOADS", "8"))
+recent_uploads: "OrderedDict[str, None]" = OrderedDict()
+background_tasks = set()
+
+MAX_CACHE_MB = int(os.environ.get("MAX_CACHE_MB", "256"))
+CACHE_TTL_SECONDS = 3600
+
+class FrameCache:
+    """LRU cache of frame bytes bounded by total size, with a per-entry TTL."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        # Every caller runs on the event loop today; the lock keeps the cache
+        # consistent should one move to asyncio.to_thread or a sync endpoint.
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at < time.monotonic():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def __setitem__(self, key: str, data: bytes):
+        with self._lock:
+            # Drop any older value first so an oversized one doesn't leave it behind.
+            self._discard(key)
+            if len(data) > self.max_bytes:
+                return
+            self._entries[key] = (data, time.monotonic() + self.ttl)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def invalidate(self, prefix: str):
+        """Drop every entry whose key starts with ``prefix``."""
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._discard(key)
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[0])
+
+# In-memory cache for frames, keyed by their path under OUTPUT_DIR
+frames_cache = FrameCache(MAX_CACHE_MB * 1024 * 1024, CACHE_TTL_SECONDS)
+
+class FrameMeta(NamedTuple):
+    etag: str
+    stat: os.stat_result
+
+# Small and never evicted with the bytes, so disk fallbacks skip the stat too
+frame_meta: Dict[str, FrameMeta] = {}
+
+# Frame filenames per upload directory; uploads never change once extracted
+frames_lists: Dict[str, List[str]] = {}
+
+# SHA-256 of each live upload's video -> its directory, to skip re-extracting it
+extracted_videos: Dict[str, str] = {}
+
+# Frame paths embed a unique upload id, so their content never changes
+FRAME_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Internal nginx location mapped to OUTPUT_DIR; unset when not behind nginx
+FRAMES_ACCEL_PREFIX = os.environ.get("FRAMES_ACCEL_PREFIX")
+
+JPEG_EOI = b"\xff\xd9"
+PIPE_BUFFER_SIZE = 1 << 20
+
+# CPU-bound frame probing runs in a process pool so it neither holds the GIL nor
+# blocks the loop. Every uvicorn worker has its own pool, so by default the cores
+# are split between them rather than each worker starting cpu_count processes.
+PROBE_WORKERS = int(os.environ.get("PROBE_WORKERS") or
+                    max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY") or 1)))
+probe_executor: Optional[ProcessPoolExecutor] = None  # Created at startup
+# Thumbnails of one upload waiting on their phash: keeps the pool busy without
+# holding the whole video's frames in memory.
+PROBE_WINDOW = 2 * PROBE_WORKERS
+DUPLICATE_DISTANCE = 5  # Max Hamming distance between near-duplicate frames
 
-def ffmpeg_exists() -> bool:
+SOURCE_FILENAME = "source"  # Uploaded video, kept only until its frames are extracted
+FRAME_FILENAME = re.compile(r"frame_\d+\.jpg")
+THUMBNAIL_DIR = "thumbs"  # Gallery thumbnails; full-size frames sit in the upload dir itself
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_QUALITY = "5"  # ffmpeg q:v, 2 (best) to 31; thumbnails are only viewed small
+FULL_QUALITY = "2"
+I_FRAME_SELECT = "select='eq(pict_type,PICT_TYPE_I)'"
+# 4:2:0 full-range: smallest baseline JPEG for the quality. The mjpeg encoder
+# already builds optimal Huffman tables by default.
+JPEG_PIX_FMT_ARGV = ("-pix_fmt", "yuvj420p")
+MJPEG_PIPE_ARGV = (*JPEG_PIX_FMT_ARGV, "-f", "image2pipe", "-vcodec", "mjpeg", "pipe:1")
+
+def _resolve_ffmpeg() -> Optional[str]:
     if getattr(sys, 'frozen', False):
         bundle_dir = os.path.dirname(sys.executable)
         ffmpeg_path = os.path.join(bundle_dir, 'ffmpeg')
         if os.path.exists(ffmpeg_path):
             os.chmod(ffmpeg_path, 0o755)
-            return True
+            return ffmpeg_path
 
     try:
         subprocess.run(["ffmpeg", "-version"],
                        check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return True
-    except:
-        return False
+        return "ffmpeg"
+    except (OSError, subprocess.CalledProcessError):
+        return None
 
-def extract_iframes(video_file_path: str, output_folder: str):
-    ffmpeg_cmd = "ffmpeg"
-    if getattr(sys, 'frozen', False):
-        bundle_dir = os.path.dirname(sys.executable)
-        ffmpeg_path = os.path.join(bundle_dir, 'ffmpeg')
-        if os.path.exists(ffmpeg_path):
-            ffmpeg_cmd = ffmpeg_path
+# Resolved once per worker instead of forking "ffmpeg -version" on every upload
+FFMPEG_PATH = _resolve_ffmpeg()
+# Errors only on stderr: no banner, per-frame stats or chatter to drain.
+BASE_FFMPEG_ARGV = (FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-nostats")
+
+HWACCEL_PREFERENCE = ("cuda", "vaapi", "videotoolbox", "qsv")
+hwaccel_disabled = False  # Set once the detected hwaccel turns out not to work
+
+@lru_cache(maxsize=None)
+def detect_hwaccel() -> Optional[str]:
+    """Return the preferred hardware decoder this ffmpeg build supports, if any."""
+    if FFMPEG_PATH is None:
+        return None
+    try:
+        result = subprocess.run([FFMPEG_PATH, "-hide_banner", "-hwaccels"],
+                                check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # First line is the "Hardware acceleration methods:" heading
+    available = {line.strip() for line in result.stdout.splitlines()[1:]}
+    return next((h for h in HWACCEL_PREFERENCE if h in available), None)
+
+async def extract_iframes(upload: AsyncIterator[bytes], video_file_path: str,
+                          output_folder: str) -> str:
+    """Decode keyframes while ``upload`` is still arriving.
+
+    The upload is piped into ffmpeg and saved to ``video_file_path`` at the same
+    time. Inputs ffmpeg can't decode from a pipe (e.g. MP4s with the index at
+    the end) are decoded again from the saved copy.
+
+    Returns the folder holding the frames. That is ``output_folder`` unless the
+    same video was extracted before, in which case the earlier folder is reused.
+    """
+    os.makedirs(os.path.join(output_folder, THUMBNAIL_DIR), exist_ok=True)
+
+    digest = hashlib.sha256()
+    try:
+        frames = await _decode_keyframes("pipe:0", output_folder,
+                                         stdin=_save_upload(upload, video_file_path, digest))
+    except HTTPException as exc:
+        # Only ffmpeg failures are worth retrying from the saved copy.
+        if exc.status_code < 500:
+            raise
+        frames = []
 
-    os.makedirs(output_folder, exist_ok=True)
+    # Re-submitted video: skip the disk decode and keep the earlier folder.
+    video_hash = digest.hexdigest()
+    if video_hash in extracted_videos:
+        await asyncio.to_thread(_mark_done, extracted_videos[video_hash])
+        return extracted_videos[video_hash]
 
-    # Clear old frames (optional)
-    for f in os.listdir(output_folder):
-        if f.endswith(".jpg") or f.endswith(".png"):
-            os.remove(os.path.join(output_folder, f))
+    if not frames:
+        # A pipe decode that failed midway may have stored some frames already.
+        _forget_frames(output_folder)
+        frames = await _decode_keyframes(video_file_path, output_folder)
+    await asyncio.to_thread(os.remove, video_file_path)
+    await asyncio.to_thread(_prune_frames, output_folder, set(frames))
 
-    command = [
-        ffmpeg_cmd, "-i", video_file_path,
-        "-vf", "select='eq(pict_type,PICT_TYPE_I)'",
-        "-vsync", "vfr",
-        os.path.join(output_folder, "frame_%d.jpg")
+    # ffmpeg wrote the full-size frames; record them too so ?full=1 skips the stat.
+    paths = [os.path.join(output_folder, filename) for filename in frames]
+    for path, stat in zip(paths, await asyncio.to_thread(_stat_all, paths)):
+        frame_meta[path] = FrameMeta(_stat_etag(stat), stat)
+
+    # Already in keyframe order, which is also numeric filename order.
+    frames_lists[output_folder] = frames
+    extracted_videos[video_hash] = output_folder
+    await asyncio.to_thread(_mark_done, output_folder)
+    return output_folder
+
+def _prune_frames(output_folder: str, keep: Set[str]):
+    # Frames dedupe dropped, or left over from a failed decode.
+    for folder in (output_folder, os.path.join(output_folder, THUMBNAIL_DIR)):
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.name.endswith(".jpg") and entry.name not in keep:
+                    os.remove(entry.path)
+
+def _stat_all(paths: List[str]) -> List[os.stat_result]:
+    return [os.stat(path) for path in paths]
+
+def _stat_etag(stat: os.stat_result) -> str:
+    # The ETag FileResponse derives from a stat, so workers without the meta agree.
+    return hashlib.md5(f"{stat.st_mtime}-{stat.st_size}".encode(),
+                       usedforsecurity=False).hexdigest()
+
+def _mark_done(upload_dir: str):
+    # Creates the marker, or bumps its mtime when a re-submitted video reuses the folder.
+    with open(os.path.join(upload_dir, UPLOAD_DONE_MARKER), "a"):
+        pass
+    os.utime(os.path.join(upload_dir, UPLOAD_DONE_MARKER))
+
+async def _save_upload(upload: AsyncIterator[bytes], path: str,
+                       digest: "hashlib._Hash") -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "wb") as out:
+        async for chunk in upload:
+            digest.update(chunk)
+            await out.write(chunk)
+            yield chunk
+
+async def _decode_keyframes(video_file_path: str, output_folder: str,
+                            stdin: Optional[AsyncIterator[bytes]] = None) -> List[str]:
+    """Write keyframes and their thumbnails to ``output_folder``.
+
+    One ffmpeg pass splits every keyframe: the full-size copy is written as
+    frame_<n>.jpg (numbered from 1) and a thumbnail comes back over the pipe,
+    so the n-th thumbnail belongs to frame_<n>.jpg.
+
+    Returns the filenames store_frames kept.
+    """
+    # Only decode keyframes; much cheaper than decoding everything and filtering.
+    frames = await store_frames(_run_decoder(
+        ["-y", "-skip_frame", "nokey", "-i", video_file_path],
+        _keyframe_outputs(output_folder, "[0:v]"),
+        stdin
+    ), output_folder)
+
+    # Some codecs don't flag keyframes, fall back to the select filter.
+    # Piped input can't be replayed; the caller retries from disk instead.
+    if not frames and stdin is None:
+        frames = await store_frames(_run_decoder(
+            ["-y", "-i", video_file_path],
+            _keyframe_outputs(output_folder, f"[0:v]{I_FRAME_SELECT},")
+        ), output_folder)
+    return frames
+
+def _keyframe_outputs(output_folder: str, source: str) -> List[str]:
+    graph = f"{source}split=2[full][thumb];[thumb]scale={THUMBNAIL_WIDTH}:-2[small]"
+    return [
+        "-filter_complex", graph,
+        "-map", "[full]", "-vsync", "vfr", "-q:v", FULL_QUALITY, *JPEG_PIX_FMT_ARGV,
+        "-f", "image2", os.path.join(output_folder, "frame_%d.jpg"),
+        "-map", "[small]", "-vsync", "vfr", "-q:v", THUMBNAIL_QUALITY, *MJPEG_PIPE_ARGV,
     ]
-    subprocess.run(command, check=True)
+
+async def _run_decoder(input_args: List[str], output_args: List[str],
+                       stdin: Optional[AsyncIterator[bytes]] = None) -> AsyncIterator[bytes]:
+    """Run ffmpeg with hardware decoding when available, retrying in software.
+
+    The retry only happens if the hardware run failed before yielding a frame.
+    """
+    global hwaccel_disabled
+    software = [*BASE_FFMPEG_ARGV, *input_args, *output_args]
+    hwaccel = None if hwaccel_disabled else detect_hwaccel()
+    if hwaccel is None:
+        async for frame in _run_ffmpeg(software, stdin):
+            yield frame
+        return
+
+    yielded = False
+    try:
+        async for frame in _run_ffmpeg([*BASE_FFMPEG_ARGV, "-hwaccel", hwaccel,
+                                        *input_args, *output_args], stdin):
+            yielded = True
+            yield frame
+        return
+    except HTTPException:
+        if stdin is not None or yielded:
+            raise
+    async for frame in _run_ffmpeg(software):
+        yield frame
+    # Listed by ffmpeg but unusable here (e.g. no GPU); stop trying it.
+    hwaccel_disabled = True
+
+async def _run_ffmpeg(command: List[str],
+                      stdin: Optional[AsyncIterator[bytes]] = None) -> AsyncIterator[bytes]:
+    """Run ffmpeg writing MJPEG to stdout and yield each JPEG as it arrives.
+
+    If ``stdin`` is given it is fed to ffmpeg and always consumed to the end.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.DEVNULL if stdin is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=PIPE_BUFFER_SIZE,
+    )
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    feed_task = None
+    if stdin is not None:
+        feed_task = asyncio.create_task(_feed_stdin(proc.stdin, stdin))
+
+    buffer = bytearray()
+    try:
+        try:
+            while chunk := await proc.stdout.read(PIPE_BUFFER_SIZE):
+                # Byte stuffing guarantees FFD9 only appears as the end-of-image marker.
+                start = max(len(buffer) - 1, 0)
+                buffer += chunk
+                while (end := buffer.find(JPEG_EOI, start)) != -1:
+                    frame = bytes(buffer[:end + len(JPEG_EOI)])
+                    del buffer[:end + len(JPEG_EOI)]
+                    start = 0
+                    yield frame
+        except BaseException:
+            # Cancelled, or the consumer gave up: stop now rather than waiting for
+            # the client to finish sending the body and ffmpeg to decode it.
+            if feed_task is not None:
+                feed_task.cancel()
+            if proc.returncode is None:
+                proc.kill()
+            raise
+
+        # Raises if reading the upload failed, e.g. a malformed request.
+        if feed_task is not None:
+            await feed_task
+    finally:
+        err = await stderr_task
+        await proc.wait()
+    if proc.returncode:
+        lines = err.decode(errors="replace").strip().splitlines()
+        reason = lines[-1] if lines else f"ffmpeg exited with {proc.returncode}"
+        raise HTTPException(status_code=500, detail=f"Error extracting frames: {reason}")
+
+async def _feed_stdin(pipe: asyncio.StreamWriter, chunks: AsyncIterator[bytes]):
+    feeding = True
+    try:
+        async for chunk in chunks:
+            # Keep consuming after ffmpeg stops reading so the upload is fully saved.
+            if not feeding:
+                continue
+            try:
+                pipe.write(chunk)
+                await pipe.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                feeding = False
+    finally:
+        pipe.close()
+
+async def _iter_upload(request: Request, boundary: bytes) -> AsyncIterator[bytes]:
+    """Yield the ``file`` field of a multipart upload as it arrives, without spooling it."""
+    pending: List[bytes] = []
+    header_field = bytearray()
+    header_value = bytearray()
+    in_file = False
+    got_file = False
+
+    def on_part_begin():
+        nonlocal in_file
+        in_file = False
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        nonlocal in_file
+        if header_field.lower() == b"content-disposition":
+            _, options = parse_options_header(bytes(header_value))
+            in_file = options.get(b"name") == b"file"
+        header_field.clear()
+        header_value.clear()
+
+    def on_part_data(data: bytes, start: int, end: int):
+        nonlocal got_file
+        if in_file and end > start:
+            pending.append(data[start:end])
+            got_file = True
+
+    parser = multipart.MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_part_data": on_part_data,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if pending:
+                yield b"".join(pending)
+                pending.clear()
+        parser.finalize()
+    except FormParserError:
+        raise HTTPException(status_code=400, detail="Malformed multipart upload.")
+    if not got_file:
+        raise HTTPException(status_code=400, detail="No video file uploaded.")
+
+def _upload_dir(upload_id: str) -> str:
+    # Upload ids are uuid4 hex strings; rejecting anything else keeps paths inside OUTPUT_DIR.
+    try:
+        if uuid.UUID(hex=upload_id).hex != upload_id:
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    return os.path.join(OUTPUT_DIR, upload_id)
+
+def _forget_frames(upload_dir: str):
+    frames_cache.invalidate(upload_dir + os.sep)
+    for key in [k for k in frame_meta if k.startswith(upload_dir + os.sep)]:
+        del frame_meta[key]
+
+def _discard_upload(upload_id: str):
+    upload_dir = os.path.join(OUTPUT_DIR, upload_id)
+    _forget_frames(upload_dir)
+    frames_lists.pop(upload_dir, None)
+    for video_hash in [h for h, d in extracted_videos.items() if d == upload_dir]:
+        del extracted_videos[video_hash]
+    task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, upload_dir, ignore_errors=True))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def _latest_upload() -> Optional[str]:
+    # Scan the disk, another worker may have finished an upload more recently.
+    # Uploads still extracting have no marker yet, and ones being deleted may
+    # vanish between the scan and the stat.
+    latest, latest_mtime = None, 0.0
+    with os.scandir(OUTPUT_DIR) as it:
+        for entry in it:
+            try:
+                mtime = os.stat(os.path.join(entry.path, UPLOAD_DONE_MARKER)).st_mtime
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if latest is None or mtime > latest_mtime:
+                latest, latest_mtime = entry.name, mtime
+    return latest
+
+def _remember_upload(upload_id: str):
+    recent_uploads[upload_id] = None
+    recent_uploads.move_to_end(upload_id)
+    # Drop the oldest frames in the background so the response isn't held up.
+    while len(recent_uploads) > KEEP_UPLOADS:
+        old_upload, _ = recent_uploads.popitem(last=False)
+        _discard_upload(old_upload)
+
+async def store_frames(thumbnails: AsyncIterator[bytes], output_folder: str) -> List[str]:
+    """Store the thumbnails ffmpeg streams out, dropping unreadable frames and
+    near-duplicates of frames already kept.
+
+    Each thumbnail is hashed in the probe pool as soon as it arrives, with at
+    most PROBE_WINDOW of them in flight, so memory stays flat however long the
+    video is. Returns the kept filenames in keyframe order.
+    """
+    loop = asyncio.get_running_loop()
+    in_flight: "Deque[Tuple[str, bytes, asyncio.Future]]" = deque()
+    kept, kept_hashes = [], []
+
+    async def settle():
+        filename, thumbnail, probe = in_flight.popleft()
+        phash = await probe
+        if phash is None:
+            return
+        if any((phash ^ h).bit_count() < DUPLICATE_DISTANCE for h in kept_hashes):
+            return
+        kept.append(filename)
+        kept_hashes.append(phash)
+
+        # Served from memory, with a copy on disk for cache misses and other workers.
+        thumbnail_path = os.path.join(output_folder, THUMBNAIL_DIR, filename)
+        frames_cache[thumbnail_path] = thumbnail
+        async with aiofiles.open(thumbnail_path, "wb") as out:
+            await out.write(thumbnail)
+        etag = f'"{hashlib.sha1(thumbnail).hexdigest()[:16]}"'
+        stat = await asyncio.to_thread(os.stat, thumbnail_path)
+        frame_meta[thumbnail_path] = FrameMeta(etag, stat)
+
+    count = 0
+    async for thumbnail in thumbnails:
+        count += 1
+        in_flight.append((f"frame_{count}.jpg", thumbnail,
+                          loop.run_in_executor(probe_executor, perceptual_hash, thumbnail)))
+        if len(in_flight) >= PROBE_WINDOW:
+            await settle()
+    while in_flight:
+        await settle()
+    return kept
 
 class FrameSelection(BaseModel):
+    upload_id: str
     filenames: List[str]
 
+@app.on_event("startup")
+def probe_hwaccel():
+    detect_hwaccel()
+
+@app.on_event("startup")
+def start_executor():
+    global probe_executor
+    # Forking a worker that already runs the event loop's threads can deadlock
+    # the children, so start them from a clean process instead.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    probe_executor = ProcessPoolExecutor(max_workers=PROBE_WORKERS, mp_context=context)
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    probe_executor.shutdown(wait=False, cancel_futures=True)
+
 @app.get("/", response_class=HTMLResponse)
 def index(request: Request):
+    upload_id = _latest_upload()
     return templates.TemplateResponse("index.html", {
         "request": request,
-        "frames": _get_frames_list(),
+        "upload_id": upload_id,
+        "frames": _get_frames_list(upload_id),
     })
 
 @app.post("/upload-video", response_class=HTMLResponse)
-async def upload_video(request: Request, file: UploadFile = File(...)):
-    if not ffmpeg_exists():
+async def upload_video(request: Request):
+    if FFMPEG_PATH is None:
         raise HTTPException(status_code=500, detail="ffmpeg not found on server.")
 
-    input_video_path = "temp_video.mp4"
-    with open(input_video_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected a multipart video upload.")
 
+    upload_id = uuid.uuid4().hex
+    upload_dir = os.path.join(OUTPUT_DIR, upload_id)
+    os.makedirs(upload_dir)
+    input_video_path = os.path.join(upload_dir, SOURCE_FILENAME)
     try:
-        extract_iframes(input_video_path, OUTPUT_DIR)
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(status_code=500, detail=f"Error extracting frames: {e}")
-    finally:
-        if os.path.exists(input_video_path):
-            os.remove(input_video_path)
+        frames_dir = await extract_iframes(_iter_upload(request, params[b"boundary"]),
+                                           input_video_path, upload_dir)
+    except BaseException:
+        _discard_upload(upload_id)
+        raise
+
+    if frames_dir != upload_dir:
+        _discard_upload(upload_id)
+        upload_id = os.path.basename(frames_dir)
+
+    _remember_upload(upload_id)
 
     return templates.TemplateResponse("index.html", {
         "request": request,
-        "frames": _get_frames_list(),
+        "upload_id": upload_id,
+        "frames": _get_frames_list(upload_id),
         "message": "Frames extracted successfully!"
     })
 
-@app.get("/frames/{filename}")
-def get_frame(filename: str):
-    file_path = os.path.join(OUTPUT_DIR, filename)
-    if not os.path.exists(file_path):
+@app.get("/frames/{upload_id}/{filename}")
+async def get_frame(request: Request, upload_id: str, filename: str, full: bool = False):
+    upload_dir = _upload_dir(upload_id)
+    # Checked by shape only; a missing frame fails the stat below (or 404s in nginx).
+    if not FRAME_FILENAME.fullmatch(filename):
+        raise HTTPException(status_code=404, detail="Frame not found.")
+
+    # The gallery loads thumbnails; ?full=1 serves the full-size frame stored beside them.
+    relative_path = filename if full else f"{THUMBNAIL_DIR}/{filename}"
+    file_path = os.path.join(upload_dir, *relative_path.split("/"))
+    headers = {"Cache-Control": FRAME_CACHE_CONTROL}
+
+    meta = frame_meta.get(file_path)
+    if meta is not None:
+        headers["ETag"] = meta.etag
+        if_none_match = request.headers.get("if-none-match", "")
+        if meta.etag in (tag.strip() for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+
+    data = frames_cache.get(file_path)
+    if data is not None:
+        return Response(content=data, media_type="image/jpeg", headers=headers)
+
+    if FRAMES_ACCEL_PREFIX:
+        headers["X-Accel-Redirect"] = f"{FRAMES_ACCEL_PREFIX}{upload_id}/{relative_path}"
+        return Response(media_type="image/jpeg", headers=headers)
+    if meta is not None:
+        return FileResponse(file_path, stat_result=meta.stat, headers=headers)
+    try:
+        stat_result = await asyncio.to_thread(os.stat, file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Frame not found.")
-    return FileResponse(file_path)
+    return FileResponse(file_path, stat_result=stat_result, headers=headers)
 
 @app.post("/download-zip")
 async def download_zip(selection: FrameSelection):
@@ -113,35 +652,55 @@ async def download_zip(selection: FrameSelection):
     if not selected_files:
         raise HTTPException(status_code=400, detail="No frames selected.")
 
-    real_files = []
-    for filename in selected_files:
-        file_path = os.path.join(OUTPUT_DIR, filename)
-        if os.path.exists(file_path):
-            real_files.append(file_path)
-
-    if not real_files:
+    upload_dir = _upload_dir(selection.upload_id)
+    # Only names from the upload's own frame list are accepted.
+    known = set(await asyncio.to_thread(_get_frames_list, selection.upload_id))
+    filenames = [name for name in selected_files if name in known]
+    if not filenames:
         raise HTTPException(status_code=400, detail="No valid frames found.")
 
-    from io import BytesIO
-    zip_buffer = BytesIO()
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     zip_filename = f"frames_{timestamp}.zip"
 
-    with ZipFile(zip_buffer, "w") as zipf:
-        for file_path in real_files:
-            arcname = os.path.basename(file_path)
-            zipf.write(file_path, arcname=arcname)
+    # Each frame is read with aiofiles only when the stream reaches it, so
+    # nothing blocks the event loop and at most one frame is held in memory.
+    async def stream():
+        zs = ZipStream()
+        for filename in filenames:
+            try:
+                async with aiofiles.open(os.path.join(upload_dir, filename), "rb") as f:
+                    data = await f.read()
+            except FileNotFoundError:
+                continue
+            zs.add(data, arcname=filename)
+            for chunk in zs.file():
+                yield chunk
+        for chunk in zs.footer():
+            yield chunk
 
-    zip_buffer.seek(0)
     headers = {"Content-Disposition": f'attachment; filename="{zip_filename}"'}
-    return StreamingResponse(zip_buffer, media_type="application/zip", headers=headers)
+    return StreamingResponse(stream(), media_type="application/zip", headers=headers)
 
 @app.post("/download-individual")
 async def download_individual(selection: FrameSelection):
     # For this demo, just re-use the ZIP logic:
-    return download_zip(selection)
+    return await download_zip(selection)
+
+def _get_frames_list(upload_id: Optional[str]) -> List[str]:
+    if upload_id is None:
+        return []
+    upload_dir = os.path.join(OUTPUT_DIR, upload_id)
+    frames = frames_lists.get(upload_dir)
+    if frames is not None:
+        return frames
 
-def _get_frames_list() -> List[str]:
-    if not os.path.exists(OUTPUT_DIR):
+    # Extracted by another worker, which may delete it later, so don't remember it.
+    if not os.path.exists(os.path.join(upload_dir, UPLOAD_DONE_MARKER)):
+        return []
+    try:
+        with os.scandir(upload_dir) as it:
+            names = [entry.name for entry in it if entry.name.endswith(".jpg")]
+    except FileNotFoundError:
         return []
-    return sorted(f for f in os.listdir(OUTPUT_DIR) if f.lower().endswith(".jpg"))
+    # frame_2.jpg before frame_10.jpg
+    return sorted(names, key=lambda name: int(name[len("frame_"):-len(".jpg")]))
@@ -0,0 +1,38 @@
+"""
+Perceptual hashing of extracted frames.
+
+Runs in the probe pool's child processes, which import this module to
+unpickle the call; it must stay free of side effects and heavy imports.
+"""
+
+import math
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image
+
+PHASH_SIZE = 32
+PHASH_BITS = 8
+
+_DCT_COS = [[math.cos(math.pi * (2 * x + 1) * u / (2 * PHASH_SIZE)) for x in range(PHASH_SIZE)]
+            for u in range(PHASH_BITS)]
+
+def perceptual_hash(data: bytes) -> Optional[int]:
+    """Return the 64-bit DCT perceptual hash of a JPEG, or None if it is unreadable."""
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # Let the JPEG decoder downscale in the DCT domain and skip chroma.
+            img.draft("L", (PHASH_SIZE, PHASH_SIZE))
+            pixels = list(img.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS)
+                          .getdata())
+    except OSError:
+        return None
+
+    rows = [pixels[i:i + PHASH_SIZE] for i in range(0, len(pixels), PHASH_SIZE)]
+    # Separable 2D DCT, keeping only the low-frequency top-left block.
+    row_dct = [[sum(c * p for c, p in zip(cos, row)) for cos in _DCT_COS] for row in rows]
+    coeffs = [sum(cos[y] * row_dct[y][u] for y in range(PHASH_SIZE))
+              for cos in _DCT_COS for u in range(PHASH_BITS)]
+
+    median = sorted(coeffs[1:])[len(coeffs) // 2]  # Skip the DC term
+    return sum(1 << i for i, c in enumerate(coeffs) if c > median)
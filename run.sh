@@ -0,0 +1,10 @@
+#!/usr/bin/env sh
+# Production entrypoint: uvloop event loop, httptools parser and one
+# worker process per core (override with WEB_CONCURRENCY). Each worker has
+# its own frame cache (MAX_CACHE_MB) and probe pool, so memory grows with
+# the worker count. Exported so the app can split the cores between workers.
+export WEB_CONCURRENCY="${WEB_CONCURRENCY:-$(nproc)}"
+exec uvicorn fastapi_app:app \
+    --host 0.0.0.0 --port "${PORT:-8000}" \
+    --loop uvloop --http httptools \
+    --workers "$WEB_CONCURRENCY"